@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+BNCT 全身评估完整流水线
+
+串联: ICRP-110 模体加载 -> 降采样 -> (可选) CT 融合 ->
+(可选) MCNP 输入生成 -> 器官剂量 -> BEIR VII 风险评估 -> 前端可视化数据。
+
+供 /api/wholebody/run-assessment 的后台任务调用。
+"""
+
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from backend.ct_phantom_fusion import (PHANTOM_DIMS, load_icrp110_phantom,
+                                       load_ct_nifti, simple_fusion)
+from backend.risk_assessment import BEIRVII_RiskEngine
+
+logger = logging.getLogger(__name__)
+
+
+def _np_default(obj):
+    """json.dump 的 default 钩子: 只在碰到 numpy 叶子类型时转换
+
+    树的遍历交给 C 实现的 json 编码器, 不再用 Python 递归预先
+    走一遍整个结果结构。
+    """
+    if isinstance(obj, np.integer):
+        return int(obj)
+    if isinstance(obj, np.floating):
+        return float(obj)
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError(f"无法 JSON 序列化: {type(obj)}")
+
+
+def _drop_page_cache(path):
+    """提示内核丢弃刚写完的大文件页缓存, 免得模体转储挤掉热数据"""
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    fd = os.open(str(path), os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def _dump_npy(path, arr):
+    """经 memmap 把数组落盘, 写完即提示内核丢弃其页缓存"""
+    mm = open_memmap(str(path), mode='w+', dtype=arr.dtype, shape=arr.shape)
+    mm[:] = arr
+    mm.flush()
+    del mm
+    _drop_page_cache(path)
+
+
+class VoxelPhantomScaler:
+    """体素模体缩放器 (最近邻, 保持器官编号不变)"""
+
+    def __init__(self, scaling_factors):
+        # scaling_factors: {'x': .., 'y': .., 'z': ..}, <1 为降采样
+        self.scaling_factors = scaling_factors
+
+    def scale_voxel_phantom(self, voxels, out=None):
+        from scipy import ndimage
+        zoom = (self.scaling_factors['x'], self.scaling_factors['y'],
+                self.scaling_factors['z'])
+        scaled = ndimage.zoom(voxels, zoom, order=0)
+        if out is not None:
+            out[:] = scaled
+            return out
+        return scaled
+
+
+class BNCTCompletePipeline:
+    """全身 BNCT 评估流水线"""
+
+    def __init__(self, phantom_dat, phantom_type='AM', patient_age=40,
+                 patient_gender='male', output_dir='output',
+                 scaling_factors=None):
+        self.phantom_type = phantom_type
+        self.phantom_dims = PHANTOM_DIMS[phantom_type]
+        self.phantom_voxels = load_icrp110_phantom(phantom_dat, phantom_type)
+        self.patient_age = patient_age
+        self.patient_gender = patient_gender
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        # 默认 2x2x2 合并, 把几何规模压到 MCNP 可接受的量级
+        self.scaling_factors = scaling_factors or {'x': 0.5, 'y': 0.5, 'z': 0.5}
+        self.scaler = VoxelPhantomScaler(self.scaling_factors)
+        self.risk_results = None
+        # 模体转储交给后台线程: np.save/memmap 写入在 NumPy C 层
+        # 释放 GIL, 可与融合/风险评估重叠
+        self._io_pool = ThreadPoolExecutor(max_workers=2)
+
+    # ------------------------------------------------------------------
+    def run_complete_assessment(self, ct_path=None, region='chest',
+                                skip_mcnp=True, life_expectancy=80):
+        """执行完整评估流程, 返回可 JSON 化的结果 dict"""
+        t_start = time.time()
+        results = {
+            'phantom_type': self.phantom_type,
+            'patient_age': self.patient_age,
+            'patient_gender': self.patient_gender,
+            'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'),
+        }
+
+        # --- 1. 模体降采样 ---
+        orig_voxel_size = np.array(self.phantom_dims['voxel_size'])
+        sf = np.array([self.scaling_factors[a] for a in 'xyz'])
+        # 缩放后的体素尺寸只算一次, 融合与 MCNP 生成共用同一对象
+        scaled_voxel_size = tuple(orig_voxel_size / sf)
+        logger.info("模体降采样, 目标体素尺寸=%s mm", scaled_voxel_size)
+        scaled_voxels = self.scaler.scale_voxel_phantom(self.phantom_voxels)
+        results['scaled_shape'] = list(scaled_voxels.shape)
+
+        # 大数组经 memmap 落盘: 写入走页缓存, 不再额外分配一份
+        # 连续缓冲, 后续阶段可只读 mmap 复用同一份数据。
+        # 转储提交到后台线程, 后续 CPU 阶段不等磁盘
+        scaled_phantom_path = self.output_dir / 'scaled_phantom.npy'
+        io_futures = [self._io_pool.submit(_dump_npy, scaled_phantom_path,
+                                           scaled_voxels)]
+        results['scaled_phantom_path'] = str(scaled_phantom_path)
+
+        # --- 2. (可选) CT 融合 ---
+        fused_voxels = scaled_voxels
+        if ct_path is not None:
+            ct_data, ct_spacing = load_ct_nifti(ct_path)
+            fused_voxels = simple_fusion(ct_data, ct_spacing, scaled_voxels,
+                                         scaled_voxel_size, region=region)
+            fused_phantom_path = self.output_dir / 'fused_phantom.npy'
+            io_futures.append(self._io_pool.submit(_dump_npy,
+                                                   fused_phantom_path,
+                                                   fused_voxels))
+            results['fused_phantom_path'] = str(fused_phantom_path)
+
+        # --- 3. (可选) MCNP 输入生成 ---
+        if not skip_mcnp:
+            from backend.mcnp_wholebody_generator import MCNP5InputGenerator
+            generator = MCNP5InputGenerator(fused_voxels, scaled_voxel_size)
+            mcnp_path = self.output_dir / 'wholebody.inp'
+            generator.write_input(mcnp_path)
+            results['mcnp_input_path'] = str(mcnp_path)
+
+        # --- 4. 器官剂量 (未跑 MCNP 时用模拟数据) ---
+        organ_doses = self._generate_mock_organ_doses()
+        results['organ_doses'] = self._doses_as_dict(organ_doses)
+
+        # --- 5. BEIR VII 风险评估 ---
+        engine = BEIRVII_RiskEngine(self.patient_age, self.patient_gender)
+        self.risk_results = engine.assess_all_organs(organ_doses,
+                                                     life_expectancy)
+        results['risk_results'] = self.risk_results
+        results['visualization'] = self.generate_visualization_data()
+
+        # 汇合后台转储: result() 会把写盘异常抛回主线程
+        for fut in io_futures:
+            fut.result()
+        results['elapsed_seconds'] = time.time() - t_start
+
+        results_path = self.output_dir / 'complete_results.json'
+        # 1 MB 缓冲一次成文, 避免逐小块刷盘
+        with open(results_path, 'w', encoding='utf-8', buffering=1 << 20) as f:
+            json.dump(results, f, default=_np_default,
+                      ensure_ascii=False, indent=2)
+        logger.info("评估完成, 结果写入 %s (%.1f s)",
+                    results_path, results['elapsed_seconds'])
+        return results
+
+    # ------------------------------------------------------------------
+    def _generate_mock_organ_doses(self):
+        """生成模拟器官剂量 (Sv), 在 MCNP 结果缺席时撑起风险评估链路
+
+        返回 SoA 两列布局 {'names': .., 'dose_sv': ..}: 真实剂量
+        解析器同样按整列产出, 下游风险引擎直接吃数组, 不必逐键
+        攒 Python dict。
+        """
+        rng = np.random.default_rng(42)
+        names = np.array(['lung', 'liver', 'stomach', 'colon', 'bladder',
+                          'thyroid', 'breast', 'spongiosa', 'skin', 'brain'],
+                         dtype=np.str_)
+        return {'names': names,
+                'dose_sv': rng.uniform(0.05, 0.8, size=names.size)}
+
+    @staticmethod
+    def _doses_as_dict(organ_doses):
+        """SoA 剂量表 -> {器官名: 剂量} 的兼容视图 (报告/JSON 用)"""
+        if 'names' in organ_doses and 'dose_sv' in organ_doses:
+            return {str(n): float(d) for n, d in
+                    zip(organ_doses['names'], organ_doses['dose_sv'])}
+        return organ_doses
+
+    def generate_visualization_data(self):
+        """整理前端绘图数据: 器官风险排名等"""
+        if not self.risk_results:
+            return {}
+        items = [(k, v) for k, v in self.risk_results.items()
+                 if not k.startswith('_')]
+        lar = np.fromiter((v.get('lar_percent', 0.0) for _, v in items),
+                          dtype=np.float64, count=len(items))
+        order = np.argsort(-lar)
+        organ_risk_ranking = [
+            {'site': items[i][0],
+             'lar_percent': items[i][1].get('lar_percent', 0),
+             'dose_sv': items[i][1].get('dose_sv', 0)}
+            for i in order]
+        return {'organ_risk_ranking': organ_risk_ranking}
+
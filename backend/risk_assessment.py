@@ -0,0 +1,502 @@
+# -*- coding: utf-8 -*-
+"""
+BEIR VII 辐射致癌风险评估引擎
+
+基于 BEIR VII Phase 2 报告的 ERR/EAR 模型, 根据 MCNP 计算得到的
+器官当量剂量 (Sv) 估算患者的终生归因风险 (LAR)。
+
+供 /api/wholebody/run-assessment 接口调用。
+"""
+
+import copy
+import json
+import logging
+import math
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+from scipy import integrate
+
+logger = logging.getLogger(__name__)
+
+try:
+    import numba
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+
+if NUMBA_AVAILABLE:
+    @njit(cache=True)
+    def _lar_sum_kernel(err, baseline_rate, start_age, end_age, surv_func):
+        """逐年求和核: surv_func 为 numba 编译的标量生存函数"""
+        total = 0.0
+        for age in range(start_age, end_age + 1):
+            total += err * baseline_rate * surv_func(float(age))
+        return total
+
+    @numba.vectorize(['float64(float64, float64, float64, float64, float64)'],
+                     cache=True)
+    def _err_kernel(beta, gamma, dose, age_e, ddref):
+        """ERR 标量核, 编译成 ufunc 后对数组剂量/年龄自动广播"""
+        # 写成条件选择而非 if 赋值, LLVM 会编译成无分支的 select/cmov
+        ddref_factor = 1.0 if dose >= 0.1 else 1.0 / ddref
+        return beta * dose * ddref_factor * np.exp(gamma * (age_e - 30.0) / 10.0)
+
+    @numba.vectorize(['float64(float64, float64, float64, float64, '
+                      'float64, float64, float64)'], cache=True)
+    def _ear_kernel(beta, gamma, eta, dose, age_e, age_a, ddref):
+        """EAR 标量核, 同上"""
+        ddref_factor = 1.0 if dose >= 0.1 else 1.0 / ddref
+        return (beta * dose * ddref_factor * np.exp(gamma * (age_e - 30.0) / 10.0)
+                * (age_a / 60.0) ** eta)
+else:
+    # 无 numba 时退化为普通 NumPy 实现, 语义一致
+    def _err_kernel(beta, gamma, dose, age_e, ddref):
+        dose = np.where(dose < 0.1, dose / ddref, dose)
+        return beta * dose * np.exp(gamma * (age_e - 30.0) / 10.0)
+
+    def _ear_kernel(beta, gamma, eta, dose, age_e, age_a, ddref):
+        dose = np.where(dose < 0.1, dose / ddref, dose)
+        return (beta * dose * np.exp(gamma * (age_e - 30.0) / 10.0)
+                * (age_a / 60.0) ** eta)
+
+
+@lru_cache(maxsize=256)
+def _age_factor(gamma, age_e):
+    """受照年龄因子 exp(gamma*(e-30)/10); (gamma, e) 组合极少, 缓存复用"""
+    return math.exp(gamma * (age_e - 30.0) / 10.0)
+
+
+def _pack_params(table, field, organ_idx, gender_idx):
+    """把嵌套 dict 参数表打包成 (n_organs, 2) 的 SoA 数组, 缺项填 0"""
+    arr = np.zeros((len(organ_idx), len(gender_idx)), dtype=np.float32)
+    for organ, i in organ_idx.items():
+        for gender, g in gender_idx.items():
+            params = table.get(organ, {}).get(gender)
+            if params is not None:
+                arr[i, g] = params[field]
+    return arr
+
+
+def _pack_scalars(table, organ_idx, gender_idx):
+    """同 _pack_params, 但表项本身就是标量 (基线发病率)"""
+    arr = np.zeros((len(organ_idx), len(gender_idx)), dtype=np.float32)
+    for organ, i in organ_idx.items():
+        for gender, g in gender_idx.items():
+            arr[i, g] = table.get(organ, {}).get(gender, 0.0)
+    return arr
+
+
+_PARAMS_NPZ = Path(__file__).with_name('beir7_params.npz')
+
+
+def _load_packed_tables(err, ear, baseline, organ_idx, gender_idx):
+    """打包参数表并与随包发布的 beir7_params.npz 对账
+
+    源 dict 永远是权威: 表只有 n_organs x 2 的 float32, 每次导入都
+    直接打包, 再与 npz 逐数组比对, 不一致或缺失时重写 npz。引擎
+    返回的是 dict 打包出的数组 —— 旧的 "npz 存在即生效" 会让源表
+    的任何修改被过期缓存悄悄吞掉。
+    """
+    packed = {
+        'organs': np.array(list(organ_idx)),
+        'err_beta': _pack_params(err, 'beta', organ_idx, gender_idx),
+        'err_gamma': _pack_params(err, 'gamma', organ_idx, gender_idx),
+        'ear_beta': _pack_params(ear, 'beta', organ_idx, gender_idx),
+        'ear_gamma': _pack_params(ear, 'gamma', organ_idx, gender_idx),
+        'ear_eta': _pack_params(ear, 'eta', organ_idx, gender_idx),
+        'baseline': _pack_scalars(baseline, organ_idx, gender_idx),
+    }
+    try:
+        with np.load(_PARAMS_NPZ) as tables:
+            stale = (set(tables.files) != set(packed)
+                     or any(not np.array_equal(tables[k], packed[k])
+                            for k in packed))
+    except (OSError, ValueError):
+        stale = True
+    if stale:
+        # 重写只是为了让随包的 npz 跟上源表, 引擎本身不回读它;
+        # 只读安装 (或并发 worker 抢写) 失败时降级为告警, 不能
+        # 让导入因此抛异常
+        try:
+            np.savez(_PARAMS_NPZ, **packed)
+        except OSError:
+            logger.warning("beir7_params.npz 过期且无法重写 (目录只读?), "
+                           "本次继续使用源表打包的参数")
+    return packed
+
+
+class BEIRVII_RiskEngine:
+    """BEIR VII 风险评估引擎 (逐个器官计算 ERR / EAR / LAR)"""
+
+    # 剂量与剂量率效能因子 (低剂量时使用)
+    DDREF = 1.5
+
+    # 年均死亡风险 (默认简化生存函数 S(a)=exp(-mu*(a-e)) 的 mu)
+    ANNUAL_MORTALITY = 0.01
+
+    # ERR 模型参数 (BEIR VII Table 12-2, 按性别), beta: 每 Sv 超额相对风险,
+    # gamma: 受照年龄修正指数 (每 10 岁)
+    ERR_PARAMETERS = {
+        'stomach':  {'male': {'beta': 0.21, 'gamma': -0.30},
+                     'female': {'beta': 0.48, 'gamma': -0.30}},
+        'colon':    {'male': {'beta': 0.63, 'gamma': -0.30},
+                     'female': {'beta': 0.43, 'gamma': -0.30}},
+        'liver':    {'male': {'beta': 0.32, 'gamma': -0.30},
+                     'female': {'beta': 0.32, 'gamma': -0.30}},
+        'lung':     {'male': {'beta': 0.32, 'gamma': -0.30},
+                     'female': {'beta': 1.40, 'gamma': -0.30}},
+        'breast':   {'female': {'beta': 0.51, 'gamma': -0.30}},
+        'prostate': {'male': {'beta': 0.12, 'gamma': -0.30}},
+        'uterus':   {'female': {'beta': 0.055, 'gamma': -0.30}},
+        'ovary':    {'female': {'beta': 0.38, 'gamma': -0.30}},
+        'bladder':  {'male': {'beta': 0.50, 'gamma': -0.30},
+                     'female': {'beta': 1.65, 'gamma': -0.30}},
+        'thyroid':  {'male': {'beta': 0.53, 'gamma': -0.83},
+                     'female': {'beta': 1.05, 'gamma': -0.83}},
+        'leukemia': {'male': {'beta': 1.1, 'gamma': -0.40},
+                     'female': {'beta': 1.2, 'gamma': -0.40}},
+        'other':    {'male': {'beta': 0.27, 'gamma': -0.30},
+                     'female': {'beta': 0.45, 'gamma': -0.30}},
+    }
+
+    # EAR 模型参数, beta: 每万人年每 Sv 超额病例数,
+    # eta: 到达年龄修正指数 ((a/60)^eta)
+    EAR_PARAMETERS = {
+        'stomach':  {'male': {'beta': 4.9, 'gamma': -0.41, 'eta': 2.8},
+                     'female': {'beta': 4.9, 'gamma': -0.41, 'eta': 2.8}},
+        'colon':    {'male': {'beta': 3.2, 'gamma': -0.41, 'eta': 2.8},
+                     'female': {'beta': 1.6, 'gamma': -0.41, 'eta': 2.8}},
+        'liver':    {'male': {'beta': 2.2, 'gamma': -0.41, 'eta': 4.1},
+                     'female': {'beta': 1.0, 'gamma': -0.41, 'eta': 4.1}},
+        'lung':     {'male': {'beta': 2.3, 'gamma': -0.41, 'eta': 5.2},
+                     'female': {'beta': 3.4, 'gamma': -0.41, 'eta': 5.2}},
+        'breast':   {'female': {'beta': 9.4, 'gamma': -0.51, 'eta': 3.5}},
+        'prostate': {'male': {'beta': 0.11, 'gamma': -0.41, 'eta': 2.8}},
+        'uterus':   {'female': {'beta': 1.2, 'gamma': -0.41, 'eta': 2.8}},
+        'ovary':    {'female': {'beta': 0.70, 'gamma': -0.41, 'eta': 2.8}},
+        'bladder':  {'male': {'beta': 1.2, 'gamma': -0.41, 'eta': 6.0},
+                     'female': {'beta': 0.75, 'gamma': -0.41, 'eta': 6.0}},
+        'thyroid':  {'male': {'beta': 0.53, 'gamma': -0.41, 'eta': 2.8},
+                     'female': {'beta': 1.05, 'gamma': -0.41, 'eta': 2.8}},
+        'leukemia': {'male': {'beta': 1.62, 'gamma': -0.40, 'eta': 1.0},
+                     'female': {'beta': 0.93, 'gamma': -0.40, 'eta': 1.0}},
+        'other':    {'male': {'beta': 6.2, 'gamma': -0.41, 'eta': 2.8},
+                     'female': {'beta': 4.8, 'gamma': -0.41, 'eta': 2.8}},
+    }
+
+    # 基线年发病率 (每人每年), 参考中国肿瘤登记年报量级
+    BASELINE_INCIDENCE = {
+        'stomach':  {'male': 0.00040, 'female': 0.00020},
+        'colon':    {'male': 0.00032, 'female': 0.00025},
+        'liver':    {'male': 0.00038, 'female': 0.00014},
+        'lung':     {'male': 0.00062, 'female': 0.00040},
+        'breast':   {'female': 0.00045},
+        'prostate': {'male': 0.00012},
+        'uterus':   {'female': 0.00012},
+        'ovary':    {'female': 0.00008},
+        'bladder':  {'male': 0.00010, 'female': 0.00004},
+        'thyroid':  {'male': 0.00008, 'female': 0.00022},
+        'leukemia': {'male': 0.00007, 'female': 0.00005},
+        'other':    {'male': 0.00110, 'female': 0.00090},
+    }
+
+    # 癌症部位 -> 器官剂量表中可能出现的名称关键词
+    # (器官名来自 ICRP-110 器官列表 / MCNP tally 注释, 中英文混排)
+    ORGAN_MAPPING = {
+        'stomach':  ['stomach', 'gastric', '胃'],
+        'colon':    ['colon', 'large intestine', 'sigmoid', 'rectum', '结肠', '直肠'],
+        'liver':    ['liver', '肝'],
+        'lung':     ['lung', 'bronchi', '肺'],
+        'breast':   ['breast', 'mammary', '乳腺'],
+        'prostate': ['prostate', '前列腺'],
+        'uterus':   ['uterus', 'uterine', 'cervix', '子宫'],
+        'ovary':    ['ovary', 'ovaries', '卵巢'],
+        'bladder':  ['bladder', 'urinary', '膀胱'],
+        'thyroid':  ['thyroid', '甲状腺'],
+        'leukemia': ['marrow', 'bone marrow', 'spongiosa', '骨髓'],
+        'other':    ['muscle', 'skin', 'brain', 'pancreas', 'spleen', 'kidney',
+                     'adrenal', 'thymus', 'oesophagus', 'esophagus',
+                     '肌肉', '皮肤', '脑', '胰', '脾', '肾', '食道'],
+    }
+
+    # SoA 参数表: 器官名/性别 -> 整数下标, 参数 -> (n_organs, 2) 数组,
+    # 热路径里把两层 dict 查找换成一次数组取值, 也为整批器官向量化做准备
+    _GENDER_IDX = {'male': 0, 'female': 1}
+    _ORGAN_IDX = {organ: i for i, organ in enumerate(ERR_PARAMETERS)}
+    _TABLES = _load_packed_tables(ERR_PARAMETERS, EAR_PARAMETERS,
+                                  BASELINE_INCIDENCE, _ORGAN_IDX, _GENDER_IDX)
+    _ERR_BETA = _TABLES['err_beta']
+    _ERR_GAMMA = _TABLES['err_gamma']
+    _EAR_BETA = _TABLES['ear_beta']
+    _EAR_GAMMA = _TABLES['ear_gamma']
+    _EAR_ETA = _TABLES['ear_eta']
+    _BASELINE = _TABLES['baseline']
+    # 潜伏期: 白血病 2 年, 实体瘤 5 年, 做成查表免去热路径分支
+    _LATENCY = np.where(np.array(list(_ORGAN_IDX)) == 'leukemia', 2, 5).astype(np.int32)
+
+    def __init__(self, patient_age=40, patient_gender='male'):
+        self.patient_age = int(patient_age)
+        self.patient_gender = patient_gender if patient_gender in ('male', 'female') else 'male'
+        # 本患者性别对应的基线发病率列, 初始化时取一次
+        self._baseline = self._BASELINE[:, self._GENDER_IDX[self.patient_gender]]
+        logger.info("初始化: 年龄=%d, 性别=%s", self.patient_age, self.patient_gender)
+
+    def calculate_err(self, organ, dose_sv, age_at_exposure):
+        """计算超额相对风险 ERR = beta * D * exp(gamma * (e-30)/10)
+
+        dose_sv / age_at_exposure 可以是标量或数组 (ufunc 广播)。
+        """
+        i = self._ORGAN_IDX.get(organ, -1)
+        if i < 0:
+            return 0.0
+        g = self._GENDER_IDX[self.patient_gender]
+        beta = self._ERR_BETA[i, g]
+        if beta == 0.0:
+            return 0.0
+        gamma = self._ERR_GAMMA[i, g]
+        # 标量路径: 年龄因子走 lru_cache, 免去重复的超越函数求值
+        if np.ndim(dose_sv) == 0 and np.ndim(age_at_exposure) == 0:
+            dose_eff = dose_sv / self.DDREF if dose_sv < 0.1 else dose_sv
+            return beta * dose_eff * _age_factor(gamma, float(age_at_exposure))
+        return _err_kernel(beta, gamma, dose_sv, age_at_exposure, self.DDREF)
+
+    def calculate_ear(self, organ, dose_sv, age_at_exposure, attained_age):
+        """计算超额绝对风险 EAR = beta * D * exp(gamma*(e-30)/10) * (a/60)^eta
+
+        标量与数组输入均可, 同 calculate_err。
+        """
+        i = self._ORGAN_IDX.get(organ, -1)
+        if i < 0:
+            return 0.0
+        g = self._GENDER_IDX[self.patient_gender]
+        beta = self._EAR_BETA[i, g]
+        if beta == 0.0:
+            return 0.0
+        gamma = self._EAR_GAMMA[i, g]
+        eta = self._EAR_ETA[i, g]
+        if (np.ndim(dose_sv) == 0 and np.ndim(age_at_exposure) == 0
+                and np.ndim(attained_age) == 0):
+            dose_eff = dose_sv / self.DDREF if dose_sv < 0.1 else dose_sv
+            return (beta * dose_eff * _age_factor(gamma, float(age_at_exposure))
+                    * (attained_age / 60.0) ** eta)
+        return _ear_kernel(beta, gamma, eta, dose_sv, age_at_exposure,
+                           attained_age, self.DDREF)
+
+    def calculate_lar(self, organ, dose_sv, life_expectancy=80, survival_function=None):
+        """计算终生归因风险 LAR (%)
+
+        LAR = ∫ ERR(D,e) * λ0 * S(a) da, 从 e+latency 积分到预期寿命。
+        用 scipy.integrate.quad 做连续自适应积分 (被积函数光滑,
+        比逐年左矩形求和更准也更快); ERR 与年龄无关, 积分前计算一次。
+
+        survival_function 需接受年龄 (标量或 np.ndarray) 并返回同形状
+        的生存概率; 缺省为常数死亡率的指数生存函数。
+        """
+        # 直接查 SoA 表, 避免 .get(..., {}).get(...) 链每次 miss
+        # 都临时分配一个空 dict
+        try:
+            baseline_rate = float(self._baseline[self._ORGAN_IDX[organ]])
+        except KeyError:
+            return 0.0
+        if baseline_rate == 0.0:
+            return 0.0
+
+        # 潜伏期: 白血病 2 年, 实体瘤 5 年
+        latency = 2 if organ == 'leukemia' else 5
+        start_age = self.patient_age + latency
+        end_age = int(life_expectancy)
+        if start_age > end_age:
+            return 0.0
+
+        # ERR 与到达年龄无关, 求和前算一次
+        err = self.calculate_err(organ, dose_sv, self.patient_age)
+
+        if survival_function is None:
+            # 缺省的常数死亡率生存函数下积分有解析解:
+            # ∫ exp(-mu*(a-e)) da = (exp(-mu*(L1-e)) - exp(-mu*(L2-e))) / mu
+            mu = self.ANNUAL_MORTALITY
+            # 标量指数用 math.exp, 绕开 np.exp 的 0 维数组封装与 ufunc 分发
+            value = err * baseline_rate * (
+                math.exp(-mu * (start_age - self.patient_age))
+                - math.exp(-mu * (end_age + 1 - self.patient_age))) / mu
+            return float(value * 100)
+
+        # numba 编译过的标量生存函数走 njit 求和核, 避免逐次回到解释器
+        if NUMBA_AVAILABLE and isinstance(survival_function,
+                                          numba.core.dispatcher.Dispatcher):
+            total = _lar_sum_kernel(err, baseline_rate, start_age, end_age,
+                                    survival_function)
+            return float(total * 100)
+
+        integrand = lambda a: err * baseline_rate * survival_function(a)
+        value, _ = integrate.quad(integrand, start_age, end_age + 1,
+                                  epsrel=1e-6)
+        return float(value * 100)
+
+    def calculate_lar_curve(self, organ, dose_sv, life_expectancy=80):
+        """返回 (ages, 累积LAR(%)) 数组, 供风险-年龄曲线一次算好多次查询
+
+        "到年龄 a 为止的 LAR" 即 cumulative[np.searchsorted(ages, a)],
+        前端画风险曲线时不必逐个年龄重算整段积分。
+        """
+        try:
+            baseline_rate = self._baseline[self._ORGAN_IDX[organ]]
+        except KeyError:
+            baseline_rate = 0.0
+        latency = 2 if organ == 'leukemia' else 5
+        start_age = self.patient_age + latency
+        end_age = int(life_expectancy)
+        if baseline_rate == 0.0 or start_age > end_age:
+            return np.empty(0), np.empty(0)
+
+        err = self.calculate_err(organ, dose_sv, self.patient_age)
+        ages = np.arange(start_age, end_age + 1, dtype=np.float64)
+        surv = np.exp(-self.ANNUAL_MORTALITY * (ages - self.patient_age))
+        cumulative = np.cumsum(err * baseline_rate * surv) * 100
+        return ages, cumulative
+
+    def assess_all_organs(self, organ_doses, life_expectancy=80):
+        """对全部癌症部位做风险评估
+
+        organ_doses: {器官名: 当量剂量(Sv)}, 或 SoA 形式的
+        {'names': ndarray[str], 'dose_sv': ndarray[float]} (剂量
+        解析器批量产出时用, 免去先攒一个 Python dict)。器官名按
+        ORGAN_MAPPING 的关键词归并到癌症部位, 同一部位多个器官取
+        平均剂量。
+
+        结果按 (剂量表, 寿命, 年龄, 性别) 做 LRU 缓存: 前端刷新页面
+        会用完全相同的输入反复调用本方法。返回深拷贝, 防止调用方
+        改动缓存内容。
+        """
+        if 'names' in organ_doses and 'dose_sv' in organ_doses:
+            key = tuple(sorted(zip(
+                (str(n) for n in organ_doses['names']),
+                (float(d) for d in organ_doses['dose_sv']))))
+        else:
+            key = tuple(sorted(organ_doses.items()))
+        return copy.deepcopy(_assess_cached(
+            key, int(life_expectancy), self.patient_age, self.patient_gender))
+
+    def _assess_all_organs_impl(self, organ_doses, life_expectancy):
+        logger.info("开始评估, 输入器官数=%d", len(organ_doses))
+        results = {}
+
+        # 1) 按关键词把输入器官剂量归并到癌症部位 (同部位取平均)
+        sites = []
+        site_doses = []
+        site_counts = []
+        names = np.array([name.lower() for name in organ_doses], dtype=np.str_)
+        doses_in = np.fromiter(organ_doses.values(), dtype=np.float64,
+                               count=len(organ_doses))
+        for site, keywords in self.ORGAN_MAPPING.items():
+            mask = np.zeros(len(names), dtype=bool)
+            for kw in keywords:
+                mask |= np.char.find(names, kw) >= 0
+            matched = int(mask.sum())
+            if matched == 0:
+                continue
+            sites.append(site)
+            site_doses.append(float(doses_in[mask].mean()))
+            site_counts.append(matched)
+
+        if not sites:
+            results['_summary'] = {
+                'total_lar_percent': 0.0,
+                'patient_age': self.patient_age,
+                'patient_gender': self.patient_gender,
+                'life_expectancy': int(life_expectancy),
+            }
+            return results
+
+        # 2) 所有部位一次性广播计算 LAR: (n_sites, n_ages) 矩阵
+        g = self._GENDER_IDX[self.patient_gender]
+        idx = np.array([self._ORGAN_IDX[s] for s in sites], dtype=np.intp)
+        doses = np.asarray(site_doses, dtype=np.float32)
+        betas = self._ERR_BETA[idx, g]
+        gammas = self._ERR_GAMMA[idx, g]
+        baselines = self._baseline[idx]
+        latencies = self._LATENCY[idx].astype(np.float32)
+
+        doses_eff = np.where(doses < 0.1, doses / self.DDREF, doses)
+        age_factor = np.exp(gammas * (self.patient_age - 30) / 10)
+        errs = betas * doses_eff * age_factor
+
+        # 整个矩阵用 float32 计算 (参数本身只有 2-3 位有效数字),
+        # 最后求和时升回 float64 保住报告精度
+        ages = np.arange(self.patient_age, int(life_expectancy) + 1,
+                         dtype=np.float32)
+        surv = np.exp(np.float32(-self.ANNUAL_MORTALITY)
+                      * (ages - np.float32(self.patient_age)))
+        in_window = ages[None, :] >= (self.patient_age + latencies)[:, None]
+        lar_matrix = (errs * baselines)[:, None] * surv[None, :] * in_window
+        lars = lar_matrix.sum(axis=1, dtype=np.float64) * 100
+
+        total_lar = 0.0
+        for k, site in enumerate(sites):
+            if lars[k] == 0.0 and errs[k] == 0.0:
+                continue
+            results[site] = {
+                'dose_sv': float(doses[k]),
+                'err': float(errs[k]),
+                'lar_percent': float(lars[k]),
+                'matched_organs': site_counts[k],
+            }
+            total_lar += float(lars[k])
+
+        results['_summary'] = {
+            'total_lar_percent': total_lar,
+            'patient_age': self.patient_age,
+            'patient_gender': self.patient_gender,
+            'life_expectancy': int(life_expectancy),
+        }
+        logger.info("评估完成, 总LAR=%.4f%%", total_lar)
+        return results
+
+    def generate_risk_report(self, results, output_path):
+        """生成文本风险报告, 同时输出一份 JSON 供前端使用"""
+        output_path = Path(output_path)
+        parent = output_path.parent
+        if not parent.exists():
+            parent.mkdir(parents=True)
+
+        summary = results.get('_summary', {})
+        organ_results = {k: v for k, v in results.items() if not k.startswith('_')}
+        sorted_results = sorted(organ_results.items(),
+                                key=lambda kv: kv[1]['lar_percent'], reverse=True)
+
+        # 整份报告用 join 一次拼好, 每个文件只落一次盘
+        header = '\n'.join([
+            "=" * 60,
+            "BEIR VII 辐射致癌风险评估报告",
+            "=" * 60,
+            f"患者年龄: {summary.get('patient_age', '-')}",
+            f"患者性别: {summary.get('patient_gender', '-')}",
+            f"预期寿命: {summary.get('life_expectancy', '-')}",
+            "-" * 60,
+            f"{'部位':<15} {'剂量(Sv)':>10} {'LAR(%)':>10} {'ERR':>8}",
+        ]) + '\n'
+        rows = [f"{site:<15} {d.get('dose_sv', 0):>10.4f} "
+                f"{d.get('lar_percent', 0):>10.6f} {d.get('err', 0):>8.4f}\n"
+                for site, d in sorted_results]
+        footer = ("-" * 60 + "\n"
+                  f"总计 LAR: {summary.get('total_lar_percent', 0):.4f}%\n")
+        output_path.write_text(header + ''.join(rows) + footer,
+                               encoding='utf-8')
+
+        json_path = output_path.with_suffix('.json')
+        json_path.write_text(json.dumps(results, ensure_ascii=False, indent=2),
+                             encoding='utf-8')
+
+        logger.info("报告已写入 %s", output_path)
+        return str(output_path)
+
+
+@lru_cache(maxsize=128)
+def _assess_cached(doses_key, life_expectancy, patient_age, patient_gender):
+    """assess_all_organs 的纯函数缓存层, key 为排序后的剂量表元组"""
+    engine = BEIRVII_RiskEngine(patient_age, patient_gender)
+    return engine._assess_all_organs_impl(dict(doses_key), life_expectancy)